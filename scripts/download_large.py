@@ -4,35 +4,149 @@ Fast parallel resumable downloader for large files using HTTP Range requests.
 
 Speed upgrades vs "parts + merge":
 - Writes directly into the final output file at the correct offsets (no merge pass).
+- Coalesces received chunks into one pwritev() per few MiB instead of a write per chunk.
 - Uses larger chunk sizes by default (8 MiB).
 - Uses per-thread sessions with tuned HTTPAdapter pool sizes.
-- Resume state tracked via tiny .state files per part (safe even if slightly stale).
+- Range workers use per-thread libcurl handles when pycurl is installed, so the
+  receive loop runs in C and each buffer is pwrite()n straight to its offset.
+  The handles share DNS and TLS session caches (one full handshake per host).
+- HTTP/2 origins (with pycurl): all ranges multiplexed as streams on one connection.
+- Smaller files on servers that support it: all ranges in one multipart/byteranges GET.
+- Single-threaded fallback over plain HTTP (Linux): body splice()d socket -> pipe -> file,
+  never copied through user space.
+- Resume state kept in one mmap'd FILE.state array, an int64 per part (safe even if slightly stale),
+  checkpointed every few MiB written rather than on every chunk.
+- --expected-sha256 hashes while downloading: inline when single-threaded, otherwise
+  a reader thread re-reads the file front to back right behind the writers (from the
+  page cache; with --direct-io via O_DIRECT, leaving the cache alone).
 
 Usage:
   python fast_download.py --url URL --out FILE
   python fast_download.py --url URL --out FILE --parts 32 --chunk-mb 8
+  python fast_download.py --url URL --out FILE --direct-io
+  python fast_download.py --url URL --out FILE --expected-sha256 HEX
 
 Notes:
 - Requires: requests
+- Optional: pycurl (faster range workers, HTTP/2 multiplexing; requests is used when missing)
 - Best performance typically with --parts 16..64 depending on server/network.
 """
 
 import argparse
+import bisect
+import errno
+import hashlib
+import io
 import math
+import mmap
 import os
+import random
+import select
+import socket
+import ssl
+import struct
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
-from threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event, Lock, Thread, local
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING as DECODABLE_ENCODINGS
 
+try:
+    import pycurl
+except ImportError:  # optional: fall back to requests' iter_content loop
+    pycurl = None
+
+
+# Upper bound for a worker's write staging buffer (smaller chunk sizes use chunk size)
+STAGE_MAX_BYTES = 4 * 1024 * 1024
+
+# O_DIRECT offsets, lengths and buffer addresses must be multiples of this
+DIRECT_IO_ALIGN = 4096
+
+# Preferred part boundary alignment, used when it still yields the requested part count
+PART_ALIGN_BYTES = 1024 * 1024
+
+# Bytes per part in the mmap'd resume state (one int64 progress counter)
+STATE_SLOT_BYTES = 8
+
+# Smallest SO_RCVBUF worth pinning (bigger chunk sizes use the chunk size)
+RCVBUF_MIN_BYTES = 4 * 1024 * 1024
+
+# Files up to this size first try all ranges in one multipart/byteranges GET
+MULTIPART_MAX_BYTES = 128 * 1024 * 1024
+
+# A part checkpoints its state once this much more reached the file, or once
+# STATE_FLUSH_INTERVAL seconds passed with anything new. A checkpoint is an 8-byte
+# store into the mmap'd state (the kernel writes it back), so these bound the
+# resume work lost to a kill rather than checkpoint overhead.
+STATE_FLUSH_BYTES = 4 * 1024 * 1024
+STATE_FLUSH_INTERVAL = 0.25
+
+# Pipe size requested for socket -> file splice(2) in single-threaded downloads
+SPLICE_PIPE_BYTES = 1024 * 1024
+
+# Longest sleep between retries of a part (seconds)
+RETRY_SLEEP_CAP = 30.0
+
+# Most buffers a single pwritev call accepts
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, OSError, ValueError):
+    IOV_MAX = 1024
 
 _tls = local()
+_curl_share = None
+_curl_share_lock = Lock()
+_seek_lock = Lock()
 
 
-def _make_session(pool_size: int) -> requests.Session:
+def _rmem_max() -> int:
+    # Linux cap on SO_RCVBUF; 0 where unknown
+    try:
+        with open("/proc/sys/net/core/rmem_max", "r", encoding="utf-8") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def _socket_options(chunk_bytes: int) -> list:
+    """
+    (level, option, value) for download sockets: TCP_NODELAY (urllib3's default),
+    SO_KEEPALIVE, and SO_RCVBUF = max(RCVBUF_MIN_BYTES, chunk_bytes) so the receive
+    window covers long fat links and one recv can drain a whole chunk.
+    SO_RCVBUF is only pinned when net.core.rmem_max allows the full size: setting it
+    turns off Linux receive autotuning, and a clamped value would be smaller than
+    what autotuning reaches by itself.
+    """
+    opts = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    rcvbuf = max(RCVBUF_MIN_BYTES, chunk_bytes)
+    if _rmem_max() >= rcvbuf:
+        opts.append((socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf))
+    return opts
+
+
+class _TunedHTTPAdapter(HTTPAdapter):
+    # HTTPAdapter whose pooled connections (direct or via proxy) get socket_options
+    def __init__(self, socket_options: list, **kwargs):
+        self.socket_options = socket_options  # before super().__init__, which builds the pool
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs["socket_options"] = self.socket_options
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+def _make_session(pool_size: int, chunk_bytes: int = 8 * 1024 * 1024) -> requests.Session:
     s = requests.Session()
     s.headers.update(
         {
@@ -40,26 +154,104 @@ def _make_session(pool_size: int) -> requests.Session:
             "Accept-Encoding": "identity",  # avoid gzip/deflate; we want raw bytes for Range
         }
     )
-    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    adapter = _TunedHTTPAdapter(
+        _socket_options(chunk_bytes), pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+    )
     s.mount("http://", adapter)
     s.mount("https://", adapter)
     return s
 
 
-def get_thread_session(pool_size: int) -> requests.Session:
+def get_thread_session(pool_size: int, chunk_bytes: int = 8 * 1024 * 1024) -> requests.Session:
     # One session per thread (requests.Session is not guaranteed thread-safe)
     if not hasattr(_tls, "session"):
-        _tls.session = _make_session(pool_size)
+        _tls.session = _make_session(pool_size, chunk_bytes)
     return _tls.session
 
 
-def probe_size_and_range(url: str, timeout=30, pool_size: int = 64):
+def _get_curl_share():
+    # DNS + TLS session caches shared by every worker handle, so only the first
+    # connection per host pays a full TLS handshake; the rest resume the session.
+    # (libcurl does not support sharing the connection cache across threads.)
+    global _curl_share
+    with _curl_share_lock:
+        if _curl_share is None:
+            sh = pycurl.CurlShare()
+            sh.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            sh.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            _curl_share = sh
+    return _curl_share
+
+
+def _new_curl(timeout=(10, 120), chunk_bytes: int = 8 * 1024 * 1024):
+    connect_timeout, read_timeout = timeout
+    socket_options = _socket_options(chunk_bytes)
+
+    def on_socket(curlfd: int, purpose: int) -> int:
+        # Runs before connect, so SO_RCVBUF still shapes the TCP window scale
+        sock = socket.fromfd(curlfd, socket.AF_INET, socket.SOCK_STREAM)  # dup; options hit the same socket
+        try:
+            for level, option, value in socket_options:
+                sock.setsockopt(level, option, value)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+        return 0  # CURL_SOCKOPT_OK
+
+    c = pycurl.Curl()
+    c.setopt(pycurl.SOCKOPTFUNCTION, on_socket)
+    c.setopt(pycurl.SHARE, _get_curl_share())
+    c.setopt(pycurl.USERAGENT, "fast-downloader/2.0")
+    c.setopt(pycurl.ACCEPT_ENCODING, "identity")  # raw bytes for Range
+    c.setopt(pycurl.FOLLOWLOCATION, True)
+    c.setopt(pycurl.NOSIGNAL, True)  # required for multi-threaded use
+    c.setopt(pycurl.TCP_KEEPALIVE, True)
+    c.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
+    # libcurl has no per-read timeout; abort if the transfer stalls for read_timeout
+    c.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+    c.setopt(pycurl.LOW_SPEED_TIME, read_timeout)
+    return c
+
+
+def get_thread_curl(timeout=(10, 120), chunk_bytes: int = 8 * 1024 * 1024):
+    # One libcurl easy handle per thread; it keeps its connection alive between ranges
+    if not hasattr(_tls, "curl"):
+        _tls.curl = _new_curl(timeout, chunk_bytes)
+    return _tls.curl
+
+
+def probe_http2(url: str, timeout=30) -> bool:
+    """
+    Returns True if the origin negotiates HTTP/2 (via TLS ALPN, so https only).
+    Always False without pycurl or an HTTP/2-enabled libcurl.
+    """
+    if pycurl is None or not url.lower().startswith("https://"):
+        return False
+    if not pycurl.version_info()[4] & pycurl.VERSION_HTTP2:
+        return False
+
+    c = _new_curl()
+    try:
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.NOBODY, True)
+        c.setopt(pycurl.TIMEOUT, timeout)
+        c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+        c.perform()
+        return c.getinfo(pycurl.INFO_HTTP_VERSION) == pycurl.CURL_HTTP_VERSION_2_0
+    except pycurl.error:
+        return False
+    finally:
+        c.close()
+
+
+def probe_size_and_range(url: str, timeout=30, pool_size: int = 64, chunk_bytes: int = 8 * 1024 * 1024):
     """
     Returns (size, range_ok). Uses:
     - HEAD for Content-Length if available
     - GET Range: bytes=0-0 to verify 206 + Content-Range (real range support)
     """
-    sess = get_thread_session(pool_size)
+    sess = get_thread_session(pool_size, chunk_bytes)
 
     size = 0
     try:
@@ -92,235 +284,1079 @@ def probe_size_and_range(url: str, timeout=30, pool_size: int = 64):
     return size, range_ok
 
 
-def single_thread_download(url: str, out: str, chunk_bytes: int, timeout=(10, 120), pool_size: int = 16) -> bool:
+def probe_multipart_ranges(url: str, timeout=30, pool_size: int = 64) -> bool:
+    """
+    Returns True if the server answers a multi-range GET with multipart/byteranges.
+    Probes non-adjacent ranges, since servers may merge adjacent ones into one.
+    """
     sess = get_thread_session(pool_size)
+    try:
+        with sess.get(
+            url,
+            headers={"Range": "bytes=0-0,2-2"},
+            stream=True,
+            timeout=timeout,
+            allow_redirects=True,
+        ) as r:
+            ctype = r.headers.get("Content-Type", "").lower()
+            return r.status_code == 206 and ctype.startswith("multipart/byteranges")
+    except Exception:
+        return False
+
+
+def _parse_content_range(value: str):
+    # "bytes 100-199/12345" -> (100, 199)
+    first = value.strip().split(" ", 1)[-1].split("/", 1)[0]
+    a, b = first.split("-", 1)
+    return int(a), int(b)
+
+
+def single_thread_download(
+    url: str,
+    out: str,
+    chunk_bytes: int,
+    timeout=(10, 120),
+    pool_size: int = 16,
+    accept_encoding: str = None,
+    expected_sha256: str = None,
+) -> bool:
+    """
+    Plain streaming GET. The body is requested as identity by default, so the file
+    matches what the ranged path would write (servers often label stored .gz files
+    Content-Encoding: gzip). accept_encoding opts into compression ("auto": every
+    encoding urllib3 can decode here, e.g. gzip/br/zstd), decoded by iter_content;
+    it is ignored with expected_sha256, which is published for the stored bytes.
+    With expected_sha256, the bytes are hashed as they are written; otherwise
+    identity bodies over plain HTTP are spliced to the file (_splice_body).
+    """
+    if accept_encoding == "auto":
+        accept_encoding = DECODABLE_ENCODINGS
+    if expected_sha256 and accept_encoding not in (None, "identity"):
+        print("--expected-sha256 given: requesting identity instead of a compressed body.")
+        accept_encoding = None
+    sess = get_thread_session(pool_size, chunk_bytes)
     print("Starting single-threaded download...")
     start_time = time.time()
     done = 0
-
-    with sess.get(url, stream=True, timeout=timeout, allow_redirects=True) as r:
+    hasher = hashlib.sha256() if expected_sha256 else None
+
+    def report(n: int):
+        nonlocal done
+        done += n
+        elapsed = max(1e-6, time.time() - start_time)
+        speed = done / elapsed
+        sys.stdout.write(f"\r{done} bytes at {speed/1024/1024:.2f} MB/s")
+        sys.stdout.flush()
+
+    headers = {"Accept-Encoding": accept_encoding or "identity"}
+    read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+    with sess.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True) as r:
         r.raise_for_status()
         with open(out, "wb") as f:
-            for chunk in r.iter_content(chunk_size=chunk_bytes):
-                if chunk:
-                    f.write(chunk)
-                    done += len(chunk)
-                    elapsed = max(1e-6, time.time() - start_time)
-                    speed = done / elapsed
-                    sys.stdout.write(f"\r{done} bytes at {speed/1024/1024:.2f} MB/s")
-                    sys.stdout.flush()
+            if hasher is not None or not _splice_body(r, f.fileno(), read_timeout, report):
+                for chunk in r.iter_content(chunk_size=chunk_bytes):
+                    if chunk:
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        report(len(chunk))
     print()
+    if hasher is not None:
+        return _sha256_matches(hasher.hexdigest(), expected_sha256)
     return True
 
 
-def _read_state(state_path: str) -> int:
+def _splice_body(r, out_fd: int, read_timeout: float, report) -> bool:
+    """
+    Moves r's body into out_fd (from offset 0) with splice(2), socket -> pipe -> file,
+    so it never enters user space. Only for identity bodies with a Content-Length on
+    a plain TCP socket; returns False without consuming anything otherwise (no
+    os.splice, TLS, chunked, encoded or read-until-close body).
+    """
+    resp = getattr(r.raw, "_fp", None)  # http.client.HTTPResponse under urllib3
+    fp = getattr(resp, "fp", None)  # its BufferedReader over the socket
+    sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    if (
+        not hasattr(os, "splice")
+        or not isinstance(sock, socket.socket)
+        or isinstance(sock, ssl.SSLSocket)
+        or getattr(resp, "chunked", True)
+        or getattr(resp, "length", None) is None
+        or r.headers.get("Content-Encoding", "identity").lower() != "identity"
+    ):
+        return False
+    import fcntl
+
+    total = resp.length
+    offset = 0
+    if total:
+        # Body bytes read along with the headers are already in fp's buffer
+        head = fp.read(min(len(fp.peek()), total))
+        _write_at(out_fd, 0, head)
+        offset = len(head)
+        report(offset)
+
+    sock_fd = sock.fileno()
+    pipe_r, pipe_w = os.pipe()
     try:
-        with open(state_path, "r", encoding="utf-8") as f:
-            v = f.read().strip()
-            return int(v) if v else 0
-    except Exception:
-        return 0
+        try:
+            fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_BYTES)
+        except (AttributeError, OSError):
+            pass  # default 64 KiB pipe
+        while offset < total:
+            try:
+                n = os.splice(sock_fd, pipe_w, min(SPLICE_PIPE_BYTES, total - offset))
+            except BlockingIOError:
+                # requests' timeout makes the socket non-blocking
+                if not select.select([sock_fd], [], [], read_timeout)[0]:
+                    raise TimeoutError(f"no data for {read_timeout} s")
+                continue
+            if not n:
+                raise RuntimeError("short_read")
+            while n:
+                m = os.splice(pipe_r, out_fd, n, offset_dst=offset)
+                offset += m
+                n -= m
+                report(m)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+    resp.length = 0  # consumed behind http.client's back: let it see the body end
+    return True
+
+
+def _sha256_matches(digest: str, expected_sha256: str) -> bool:
+    expected_sha256 = expected_sha256.strip().lower()
+    if digest != expected_sha256:
+        print(f"SHA-256 mismatch: got {digest}, expected {expected_sha256}.")
+        return False
+    print(f"SHA-256 verified: {digest}")
+    return True
+
+
+def _open_state(state_path: str, nparts: int) -> mmap.mmap:
+    """
+    Maps the resume state: one little-endian int64 per part holding the bytes of
+    that part already written to the output. A file of the wrong length (e.g. a
+    different --parts) is zeroed rather than misread.
+    """
+    length = nparts * STATE_SLOT_BYTES
+    fd = os.open(state_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != length:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, length)
+        return mmap.mmap(fd, length)
+    finally:
+        os.close(fd)
 
 
-def _write_state(state_path: str, value: int):
-    # Atomic-ish update: write temp then replace
-    tmp = state_path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        f.write(str(value))
-    os.replace(tmp, state_path)
+def _read_state(state: mmap.mmap, index: int) -> int:
+    o = index * STATE_SLOT_BYTES
+    return int.from_bytes(state[o:o + STATE_SLOT_BYTES], "little")
 
 
-def _write_at(fd: int, offset: int, data: bytes):
-    # Use pwrite if available (avoids lseek); otherwise safe with per-thread fd + lseek/write
+def _read_all_state(state: mmap.mmap, nparts: int) -> tuple:
+    # Every slot in one unpack (same little-endian unsigned layout as _read_state)
+    return struct.unpack_from(f"<{nparts}Q", state)
+
+
+def _write_state(state: mmap.mmap, index: int, value: int):
+    # Aligned 8-byte store into a shared mapping; each worker owns its slot,
+    # and the kernel writes the page back even if the process is killed
+    o = index * STATE_SLOT_BYTES
+    state[o:o + STATE_SLOT_BYTES] = value.to_bytes(STATE_SLOT_BYTES, "little")
+
+
+def _next_retry_sleep(backoff: float, prev_sleep: float) -> float:
+    """
+    Decorrelated jitter: each part draws its next sleep from [backoff, 3 * prev_sleep],
+    so workers that failed together (e.g. on a 503) do not all retry together.
+    """
+    return min(RETRY_SLEEP_CAP, random.uniform(backoff, prev_sleep * 3))
+
+
+def _preallocate(fd: int, size: int):
+    """
+    Extends fd to size with real blocks behind it, so workers writing at random
+    offsets don't stall on filesystem block allocation mid-transfer, and a full
+    disk (ENOSPC/EFBIG, raised as OSError) is reported before any download.
+    Falls back to a sparse ftruncate where the filesystem can't preallocate.
+    """
+    # Errors meaning "no preallocation here"; anything else is a real failure
+    unsupported = (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+    if sys.platform.startswith("linux"):
+        # fallocate(2) itself: glibc's posix_fallocate emulates unsupported
+        # filesystems (NFSv3, some CIFS) by writing one byte per block
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        while fallocate(fd, 0, 0, size) != 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in unsupported:
+                break
+            raise OSError(err, os.strerror(err))
+        else:
+            return
+    elif hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as exc:
+            if exc.errno not in unsupported:
+                raise
+    elif sys.platform == "darwin":
+        import fcntl
+
+        grow = size - os.fstat(fd).st_size
+        if grow > 0:
+            # fstore_t {fst_flags, fst_posmode, fst_offset, fst_length, fst_bytesalloc}
+            F_ALLOCATEALL, F_PEOFPOSMODE = 0x4, 3
+            fstore = struct.pack("Iiqqq", F_ALLOCATEALL, F_PEOFPOSMODE, 0, grow, 0)
+            try:
+                fcntl.fcntl(fd, getattr(fcntl, "F_PREALLOCATE", 42), fstore)
+            except OSError as exc:
+                if exc.errno not in unsupported + (errno.ENOTSUP,):
+                    raise
+    os.ftruncate(fd, size)
+
+
+def _write_at(fd: int, offset: int, data):
+    # Use pwrite if available (offset per call, safe on the shared fd); otherwise
+    # lseek/write, serialized because the shared fd has a single file position
+    view = memoryview(data)
     pwrite = getattr(os, "pwrite", None)
-    if pwrite is not None:
-        pwrite(fd, data, offset)
-    else:
-        os.lseek(fd, offset, os.SEEK_SET)
-        os.write(fd, data)
+    while view:
+        if pwrite is not None:
+            n = pwrite(fd, view, offset)
+        else:
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+
+def _writev_at(fd: int, offset: int, buffers: list):
+    # One pwritev for the whole batch; fall back to a single joined pwrite without it
+    pwritev = getattr(os, "pwritev", None)
+    if pwritev is None:
+        _write_at(fd, offset, b"".join(buffers))
+        return
+    i = 0
+    while i < len(buffers):
+        n = pwritev(fd, buffers[i:i + IOV_MAX], offset)
+        offset += n
+        # Skip fully written buffers; trim a partially written one and go again
+        while i < len(buffers) and n >= len(buffers[i]):
+            n -= len(buffers[i])
+            i += 1
+        if n:
+            buffers[i] = memoryview(buffers[i])[n:]
+
+
+class _StagedWriter:
+    """
+    Collects a part's incoming network buffers and writes them out once at
+    least stage_bytes are pending, instead of one pwrite per received chunk.
+    Buffered mode keeps references to the chunks (callers must not reuse them)
+    and flushes them with a single pwritev. readinto instead lets the socket fill
+    a preallocated staging buffer in place, with no bytes object per chunk.
+
+    With direct_path set, fd is opened O_DIRECT: chunks are copied into a
+    page-aligned staging buffer written in DIRECT_IO_ALIGN multiples, and only
+    the final sub-block tail is written through a plain fd opened on direct_path.
+    """
+
+    def __init__(self, fd: int, offset: int, stage_bytes: int, direct_path: str = None):
+        self.fd = fd
+        self.offset = offset  # file offset of the first pending byte
+        self.stage_bytes = stage_bytes
+        self.direct_path = direct_path
+        self.pending = []  # buffered mode write()
+        self.buf = None  # direct mode and readinto(), allocated on first use
+        self.fill = 0
+
+    def _staging(self):
+        if self.buf is None:
+            # Anonymous mmap memory is page-aligned, as O_DIRECT requires
+            self.buf = mmap.mmap(-1, self.stage_bytes) if self.direct_path else bytearray(self.stage_bytes)
+        return self.buf
+
+    def write(self, data) -> int:
+        """Queues data; returns how many bytes reached the file."""
+        if self.direct_path is None:
+            self.pending.append(data)
+            self.fill += len(data)
+            if self.fill >= self.stage_bytes or len(self.pending) >= IOV_MAX:
+                return self.flush()
+            return 0
+
+        buf = self._staging()
+        data = memoryview(data)
+        written = 0
+        while data:
+            n = min(len(data), self.stage_bytes - self.fill)
+            buf[self.fill:self.fill + n] = data[:n]
+            self.fill += n
+            data = data[n:]
+            if self.fill == self.stage_bytes:
+                written += self.flush()
+        return written
+
+    def readinto(self, readinto) -> tuple:
+        """
+        Calls readinto(view) on the free end of the staging buffer, writing it out
+        once full. Returns (bytes received, bytes that reached the file); a part
+        must use either write() or readinto(), not both.
+        """
+        view = memoryview(self._staging())[self.fill:]
+        try:
+            received = readinto(view) or 0
+        finally:
+            view.release()
+        self.fill += received
+        if self.fill == self.stage_bytes:
+            return received, self.flush()
+        return received, 0
+
+    def flush(self) -> int:
+        """Writes whatever is pending; returns how many bytes reached the file."""
+        n = self.fill
+        if not n:
+            return 0
+        if self.pending:
+            _writev_at(self.fd, self.offset, self.pending)
+            self.pending = []
+        else:
+            view = memoryview(self.buf)[:n]
+            head = n if self.direct_path is None else n - n % DIRECT_IO_ALIGN
+            if head:
+                _write_at(self.fd, self.offset, view[:head])
+            if head < n:
+                # Unaligned tail (end of file or short read): write it without O_DIRECT
+                tail_fd = os.open(self.direct_path, os.O_WRONLY)
+                try:
+                    _write_at(tail_fd, self.offset + head, view[head:])
+                finally:
+                    os.close(tail_fd)
+            view.release()
+        self.offset += n
+        self.fill = 0
+        return n
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.buf = None
+
+
+def _fetch_range_requests(url: str, range_start: int, end: int, sink, chunk_bytes: int, pool_size: int, timeout):
+    """
+    Streams bytes=range_start-end into sink (a _PartSink) using requests.
+    Returns None on success, or an error tag if the server did not honor the Range.
+    """
+    sess = get_thread_session(pool_size, chunk_bytes)
+    headers = {"Range": f"bytes={range_start}-{end}"}
+    with sess.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True) as r:
+        # Must honor Range for parallel mode
+        if r.status_code != 206:
+            return f"range_not_honored_status_{r.status_code}"
+        if "Content-Range" not in r.headers:
+            return "missing_content_range"
+        r.raise_for_status()
+
+        # urllib3 wraps an http.client response, whose readinto() handles
+        # Content-Length and chunked framing: receive straight into the sink's
+        # staging buffer. Encoded bodies still go through iter_content's decoder.
+        fp = getattr(r.raw, "_fp", None)
+        if r.headers.get("Content-Encoding", "identity").lower() == "identity" and hasattr(fp, "readinto"):
+            while sink.receive(fp.readinto):
+                pass
+            if fp.isclosed():
+                # urllib3 did not see the body end: hand the connection back to
+                # the pool, or Response.close() would drop it (no keep-alive)
+                r.raw.release_conn()
+        else:
+            for chunk in r.iter_content(chunk_size=chunk_bytes):
+                if chunk:
+                    sink.on_chunk(chunk)
+    return None
+
+
+class _CurlRange:
+    """
+    Header/write callbacks for one ranged libcurl transfer. Bodies are handed to
+    on_chunk only once the response is a 206 with Content-Range, so a server that
+    ignores Range never gets written at the part's offset.
+    """
+
+    def __init__(self, on_chunk):
+        self.on_chunk = on_chunk
+        self.status = 0
+        self.has_content_range = False
+        self.callback_error = None
+
+    def setup(self, c, url: str, range_start: int, end: int, chunk_bytes: int):
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.RANGE, f"{range_start}-{end}")
+        c.setopt(pycurl.BUFFERSIZE, chunk_bytes)  # libcurl clamps to its own maximum
+        c.setopt(pycurl.HEADERFUNCTION, self.on_header)
+        c.setopt(pycurl.WRITEFUNCTION, self.on_write)
+
+    def on_header(self, line: bytes):
+        if line.startswith(b"HTTP/"):
+            # A new status line starts every response (one per redirect hop)
+            fields = line.split()
+            self.status = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 0
+            self.has_content_range = False
+        elif line[:14].lower() == b"content-range:":
+            self.has_content_range = True
+
+    def on_write(self, data: bytes):
+        if self.status != 206 or not self.has_content_range:
+            return 0  # abort transfer
+        try:
+            self.on_chunk(data)
+        except Exception as e:
+            self.callback_error = e
+            return 0
+
+    def result(self, error: Exception = None):
+        """
+        Given the transfer's pycurl.error (or None), returns None on success or an
+        error tag if the server did not honor the Range; re-raises other failures.
+        """
+        if self.callback_error is not None:
+            raise self.callback_error
+        if self.status and self.status != 206:
+            return f"range_not_honored_status_{self.status}"
+        if error is not None:
+            raise error
+        if self.status != 206:
+            return f"range_not_honored_status_{self.status}"
+        if not self.has_content_range:
+            return "missing_content_range"
+        return None
+
+
+def _fetch_range_curl(url: str, range_start: int, end: int, sink, chunk_bytes: int, timeout):
+    """
+    Same contract as _fetch_range_requests, but libcurl runs the receive loop and
+    hands each buffer to sink.on_chunk via WRITEFUNCTION (no iter_content re-slicing).
+    """
+    c = get_thread_curl(timeout, chunk_bytes)
+    rng = _CurlRange(sink.on_chunk)
+    rng.setup(c, url, range_start, end, chunk_bytes)
+    try:
+        c.perform()
+    except pycurl.error as e:
+        return rng.result(e)
+    return rng.result()
+
+
+class _PartSink:
+    """
+    Receives one attempt's bytes for a part: writes them through a _StagedWriter,
+    counts progress and checkpoints the bytes that reached the file into state.
+    """
+
+    def __init__(self, fd, out_path, start, done_bytes, state, index, progress, stage_bytes, direct_io):
+        self.state = state
+        self.index = index
+        self.progress = progress
+        # State only counts bytes that reached the file, never staged ones
+        self.local_done = done_bytes
+        self.last_flushed = done_bytes
+        self.last_state_flush = time.time()
+        self.writer = _StagedWriter(fd, start + done_bytes, stage_bytes, out_path if direct_io else None)
+
+    def on_chunk(self, chunk):
+        self.local_done += self.writer.write(chunk)
+
+        # Only this part's sink writes progress[index]: no lock needed
+        self.progress[self.index] += len(chunk)
+        self._checkpoint()
+
+    def receive(self, readinto) -> int:
+        """Like on_chunk, but readinto(view) fills the staging buffer; returns bytes received."""
+        received, written = self.writer.readinto(readinto)
+        self.local_done += written
+        self.progress[self.index] += received
+        self._checkpoint()
+        return received
+
+    def _checkpoint(self):
+        # Record bytes that reached the file once STATE_FLUSH_BYTES accumulated or
+        # STATE_FLUSH_INTERVAL passed (the resume point _OrderedHasher follows)
+        delta = self.local_done - self.last_flushed
+        if not delta:
+            return
+        now = time.time()
+        if delta >= STATE_FLUSH_BYTES or now - self.last_state_flush >= STATE_FLUSH_INTERVAL:
+            _write_state(self.state, self.index, self.local_done)
+            self.last_flushed = self.local_done
+            self.last_state_flush = now
+
+    @property
+    def position(self) -> int:
+        """File offset the next received byte belongs at."""
+        return self.writer.offset + self.writer.fill
+
+    def finish(self) -> int:
+        """Writes out pending bytes and checkpoints; returns the part's bytes on disk."""
+        self.local_done += self.writer.flush()
+        self.writer.close()
+        _write_state(self.state, self.index, self.local_done)
+        return self.local_done
+
+    def abandon(self):
+        """
+        After a failed attempt: checkpoints the contiguous prefix that reached the
+        file (flushing staged bytes if possible), so the retry resumes there. Never raises.
+        """
+        try:
+            self.finish()
+        except Exception:
+            _write_state(self.state, self.index, self.local_done)
 
 
 def download_part_direct(
     url: str,
+    fd: int,
     out_path: str,
     start: int,
     end: int,
-    state_path: str,
-    progress,
-    lock: Lock,
+    state: mmap.mmap,
+    index: int,
+    progress: list,
     retries: int,
     backoff: float,
     chunk_bytes: int,
     pool_size: int,
+    direct_io: bool = False,
     timeout=(10, 120),
 ):
     """
-    Downloads range [start, end] directly into out_path at the proper offsets.
-    Resume is tracked by state_path (bytes already written for this part).
+    Downloads range [start, end] directly into out_path at the proper offsets,
+    writing through fd (shared by all workers; opened O_DIRECT when direct_io).
+    Resume is tracked by slot index of state (bytes already written for this part).
     If state is stale, we may re-download some bytes, but we overwrite at offset => safe.
+    With direct_io, start must be DIRECT_IO_ALIGN-aligned (parallel_download aligns parts).
     """
     expected = end - start + 1
+    stage_bytes = min(chunk_bytes, STAGE_MAX_BYTES)
 
-    # Each worker uses its own file descriptor (safe concurrent writes)
-    fd = os.open(out_path, os.O_WRONLY)
+    attempt = 0
+    prev_sleep = backoff
+    while attempt <= retries:
+        done_bytes = _read_state(state, index)
+        if done_bytes >= expected:
+            return True, "ok"
+        if direct_io:
+            # Resume from a block boundary (a short read may have left an unaligned tail)
+            done_bytes -= done_bytes % DIRECT_IO_ALIGN
 
-    try:
-        attempt = 0
-        while attempt <= retries:
-            done_bytes = _read_state(state_path)
-            if done_bytes >= expected:
+        range_start = start + done_bytes
+
+        sink = None
+        try:
+            sink = _PartSink(fd, out_path, start, done_bytes, state, index, progress, stage_bytes, direct_io)
+            if pycurl is not None:
+                err = _fetch_range_curl(url, range_start, end, sink, chunk_bytes, timeout)
+            else:
+                err = _fetch_range_requests(url, range_start, end, sink, chunk_bytes, pool_size, timeout)
+            if err is not None:
+                return False, err
+
+            # Final flush
+            sink.finish()
+
+            # Verify complete
+            if _read_state(state, index) >= expected:
                 return True, "ok"
 
-            range_start = start + done_bytes
-            headers = {"Range": f"bytes={range_start}-{end}"}
+            # If server ended early, retry
+            raise RuntimeError("short_read")
 
-            try:
-                sess = get_thread_session(pool_size)
-                with sess.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True) as r:
-                    # Must honor Range for parallel mode
-                    if r.status_code != 206:
-                        return False, f"range_not_honored_status_{r.status_code}"
-                    if "Content-Range" not in r.headers:
-                        return False, "missing_content_range"
-                    r.raise_for_status()
-
-                    # Update state occasionally (not every chunk write to avoid overhead)
-                    last_state_flush = time.time()
-                    local_done = done_bytes
-                    write_offset = start + local_done
-
-                    for chunk in r.iter_content(chunk_size=chunk_bytes):
-                        if not chunk:
-                            continue
+        except Exception as e:
+            if sink is not None:
+                sink.abandon()
+            attempt += 1
+            if attempt > retries:
+                return False, f"exception: {e}"
+            prev_sleep = _next_retry_sleep(backoff, prev_sleep)
+            time.sleep(prev_sleep)
 
-                        _write_at(fd, write_offset, chunk)
-                        write_offset += len(chunk)
-                        local_done += len(chunk)
+    return False, "unknown"
 
-                        with lock:
-                            progress[0] += len(chunk)
 
-                        # Flush state at most ~4x/sec
-                        now = time.time()
-                        if now - last_state_flush >= 0.25:
-                            _write_state(state_path, local_done)
-                            last_state_flush = now
+def download_parts_multipart(
+    url: str,
+    fd: int,
+    out_path: str,
+    tasks: list,
+    state: mmap.mmap,
+    progress: list,
+    chunk_bytes: int,
+    pool_size: int,
+    direct_io: bool = False,
+    timeout=(10, 120),
+) -> int:
+    """
+    Fetches the remaining bytes of every (index, start, end) task with a single GET
+    (Range: bytes=a-b,c-d,...) and splits the multipart/byteranges reply into the
+    parts at their offsets. Bytes received are checkpointed even if the reply is cut
+    short; parts left incomplete are for download_part_direct to finish.
+    Returns the number of parts completed.
+    """
+    stage_bytes = min(chunk_bytes, STAGE_MAX_BYTES)
+    sinks = {}
+    ranges = []
+    for (i, s, e) in tasks:
+        done_bytes = _read_state(state, i)
+        if done_bytes >= e - s + 1:
+            continue
+        if direct_io:
+            done_bytes -= done_bytes % DIRECT_IO_ALIGN
+        sinks[i] = _PartSink(fd, out_path, s, done_bytes, state, i, progress, stage_bytes, direct_io)
+        ranges.append(f"{s + done_bytes}-{e}")
+    if not sinks:
+        return 0
+    starts = [s for (_, s, _) in tasks]
+
+    def copy_range(reader, first: int, last: int):
+        # Body bytes [first, last] may span several parts if the server merged ranges
+        offset = first
+        while offset <= last:
+            i, s, e = tasks[bisect.bisect_right(starts, offset) - 1]
+            sink = sinks.get(i)
+            if sink is None or sink.position != offset:
+                raise RuntimeError(f"unexpected_range_at_{offset}")
+            limit = min(last, e) + 1 - offset
+            n = sink.receive(lambda view: reader.readinto(view[:limit]))
+            if not n:
+                raise RuntimeError("short_read")
+            offset += n
 
-                    # Final flush
-                    _write_state(state_path, local_done)
+    sess = get_thread_session(pool_size, chunk_bytes)
+    headers = {"Range": "bytes=" + ",".join(ranges)}
+    try:
+        with sess.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True) as r:
+            if r.status_code != 206:
+                return 0
+            reader = io.BufferedReader(r.raw, buffer_size=stage_bytes)
+            ctype = r.headers.get("Content-Type", "")
+            if not ctype.lower().startswith("multipart/byteranges"):
+                # Server collapsed everything into one range
+                copy_range(reader, *_parse_content_range(r.headers["Content-Range"]))
+                return sum(1 for (i, s, e) in tasks if i in sinks and sinks[i].position > e)
+
+            boundary = ctype.split("boundary=", 1)[1].split(";", 1)[0].strip().strip('"').encode("latin-1")
+            delimiter = b"--" + boundary
+            while True:
+                line = reader.readline()
+                if not line or line.strip() == delimiter + b"--":
+                    break
+                if line.strip() != delimiter:
+                    continue  # CRLF / preamble before the next delimiter
+
+                # Part headers up to the blank line; only Content-Range matters
+                part_range = None
+                while True:
+                    header = reader.readline()
+                    if not header.strip():
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-range":
+                        part_range = _parse_content_range(value)
+                if part_range is None:
+                    raise RuntimeError("multipart_part_without_content_range")
+                copy_range(reader, *part_range)
+    finally:
+        for sink in sinks.values():
+            sink.finish()
 
-                # Verify complete
-                if _read_state(state_path) >= expected:
-                    return True, "ok"
+    return sum(1 for (i, s, e) in tasks if i in sinks and sinks[i].position > e)
 
-                # If server ended early, retry
-                raise RuntimeError("short_read")
 
-            except Exception as e:
-                attempt += 1
-                if attempt > retries:
-                    return False, f"exception: {e}"
-                time.sleep(backoff ** attempt)
+def download_parts_multiplexed(
+    url: str,
+    fd: int,
+    out_path: str,
+    tasks: list,
+    state: mmap.mmap,
+    progress: list,
+    retries: int,
+    backoff: float,
+    chunk_bytes: int,
+    direct_io: bool = False,
+    timeout=(10, 120),
+):
+    """
+    HTTP/2 counterpart of download_part_direct covering every (index, start, end)
+    task at once: each range is a stream on one multiplexed connection (one TLS
+    handshake, one congestion window), all driven by a CurlMulti in this thread.
+    Resume and retry rules match download_part_direct. Returns (success, msg) with
+    the first failure's message.
+    """
+    stage_bytes = min(chunk_bytes, STAGE_MAX_BYTES)
+    m = pycurl.CurlMulti()
+    m.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+    m.setopt(pycurl.M_MAX_HOST_CONNECTIONS, 1)
 
-        return False, "unknown"
+    attempts = {i: 0 for (i, _, _) in tasks}
+    prev_sleeps = {i: backoff for (i, _, _) in tasks}
+    pending = [(0.0, t) for t in tasks]  # (not_before, task) still to (re)start
+    active = {}  # curl handle -> (task, sink, rng)
+    failures = []
 
+    try:
+        while pending or active:
+            now = time.time()
+            ready = [t for (not_before, t) in pending if not_before <= now]
+            pending = [(nb, t) for (nb, t) in pending if nb > now]
+            for (i, s, e) in ready:
+                done_bytes = _read_state(state, i)
+                if done_bytes >= e - s + 1:
+                    continue
+                if direct_io:
+                    done_bytes -= done_bytes % DIRECT_IO_ALIGN
+                sink = _PartSink(fd, out_path, s, done_bytes, state, i, progress, stage_bytes, direct_io)
+                rng = _CurlRange(sink.on_chunk)
+                c = _new_curl(timeout, chunk_bytes)
+                c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+                c.setopt(pycurl.PIPEWAIT, True)  # wait to multiplex rather than open new connections
+                rng.setup(c, url, s + done_bytes, e, chunk_bytes)
+                m.add_handle(c)
+                active[c] = ((i, s, e), sink, rng)
+
+            if not active:
+                if not pending:
+                    break  # every remaining task was already complete in state
+                time.sleep(max(0.0, min(nb for (nb, _) in pending) - time.time()))
+                continue
+
+            while m.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+
+            finished = []
+            while True:
+                queued, ok_list, err_list = m.info_read()
+                finished += [(c, None) for c in ok_list]
+                finished += [(c, pycurl.error(errno, msg)) for (c, errno, msg) in err_list]
+                if not queued:
+                    break
+
+            for c, error in finished:
+                task, sink, rng = active.pop(c)
+                m.remove_handle(c)
+                c.close()
+                i, s, e = task
+                try:
+                    err = rng.result(error)
+                    if err is not None:
+                        failures.append(err)
+                        continue
+                    if sink.finish() >= e - s + 1:
+                        continue
+                    # If server ended early, retry
+                    raise RuntimeError("short_read")
+                except Exception as exc:
+                    sink.abandon()
+                    attempts[i] += 1
+                    if attempts[i] > retries:
+                        failures.append(f"exception: {exc}")
+                    else:
+                        prev_sleeps[i] = _next_retry_sleep(backoff, prev_sleeps[i])
+                        pending.append((time.time() + prev_sleeps[i], task))
+
+            if active:
+                # Sleep until socket activity or libcurl's next internal deadline
+                wake_ms = m.timeout()
+                if wake_ms != 0:
+                    m.select(0.5 if wake_ms < 0 else min(0.5, wake_ms / 1000.0))
     finally:
-        os.close(fd)
+        for c in active:
+            m.remove_handle(c)
+            c.close()
+        m.close()
 
+    if failures:
+        return False, failures[0]
+    return True, "ok"
+
+
+def _report_progress(progress: list, size: int, start_time: float, stop: Event):
+    # Progress line every 0.5 s until stop is set. Reads the per-part counters
+    # without locking; a slightly stale total is fine for display.
+    while not stop.wait(0.5):
+        done_bytes = sum(progress)
+        pct = done_bytes / size * 100.0
+        speed = done_bytes / max(1e-6, time.time() - start_time)
+        sys.stdout.write(f"\r{done_bytes}/{size} bytes ({pct:.2f}%) at {speed/1024/1024:.2f} MB/s")
+        sys.stdout.flush()
+
+
+class _OrderedHasher:
+    """
+    SHA-256 of the output file, computed by a thread while parts still download.
+    It reads each part front to back, never past the bytes its state slot says
+    reached the file, so it trails the first unfinished part and is left with only
+    the unhashed tail once downloads_done is set.
+
+    This is a re-read, not inline hashing (parts finish out of order): buffered
+    writes are normally still in the page cache, so it costs memory bandwidth, not
+    disk. With direct_io it reads through its own O_DIRECT fd into an aligned buffer,
+    keeping the file out of the page cache (or, if that open fails, drops each span
+    from the cache with POSIX_FADV_DONTNEED once hashed).
+    """
 
-def parallel_download(url: str, out: str, parts: int, retries: int, chunk_mb: int):
+    def __init__(self, path: str, tasks: list, state: mmap.mmap, read_bytes: int, direct_io: bool = False):
+        self.path = path
+        self.tasks = tasks
+        self.state = state
+        self.read_bytes = read_bytes  # a DIRECT_IO_ALIGN multiple
+        self.direct_io = direct_io
+        self.hasher = hashlib.sha256()
+        self.offset = 0  # bytes hashed so far
+        self.error = None
+        self.downloads_done = Event()
+
+    def run(self):
+        buf = view = None
+        drop_cache = False
+        try:
+            fd = None
+            if self.direct_io:
+                try:
+                    fd = os.open(self.path, os.O_RDONLY | os.O_DIRECT)
+                    buf = mmap.mmap(-1, self.read_bytes)  # page-aligned, as O_DIRECT requires
+                    view = memoryview(buf)
+                except (AttributeError, OSError):
+                    drop_cache = hasattr(os, "posix_fadvise")
+            if fd is None:
+                fd = os.open(self.path, os.O_RDONLY)
+            try:
+                for (i, s, e) in self.tasks:
+                    while self.offset <= e:
+                        end = min(s + _read_state(self.state, i), e + 1, self.offset + self.read_bytes)
+                        if view is not None and end <= e:
+                            end -= end % DIRECT_IO_ALIGN  # whole blocks, except at the file's end
+                        if end <= self.offset:
+                            if self.downloads_done.is_set():
+                                return  # part left incomplete
+                            self.downloads_done.wait(0.2)
+                            continue
+                        n = end - self.offset
+                        if view is None:
+                            data = os.pread(fd, n, self.offset)
+                            got = len(data)
+                        else:
+                            # O_DIRECT lengths are whole blocks too; the last one stops at EOF
+                            span = (n + DIRECT_IO_ALIGN - 1) & ~(DIRECT_IO_ALIGN - 1)
+                            got = os.preadv(fd, [view[:span]], self.offset)
+                        if got < n:
+                            raise RuntimeError(f"unexpected_eof_at_{self.offset + got}")
+                        self.hasher.update(data if view is None else view[:n])
+                        if drop_cache:
+                            os.posix_fadvise(fd, self.offset, n, os.POSIX_FADV_DONTNEED)
+                        self.offset += n
+            finally:
+                os.close(fd)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            if view is not None:
+                view.release()
+                buf.close()
+
+
+def parallel_download(
+    url: str,
+    out: str,
+    parts: int,
+    retries: int,
+    chunk_mb: int,
+    direct_io: bool = False,
+    accept_encoding: str = None,
+    expected_sha256: str = None,
+):
     chunk_bytes = max(1, chunk_mb) * 1024 * 1024
 
     # Pool size: keep up with parts (but don't go crazy)
     pool_size = min(max(16, parts), 128)
 
-    size, range_ok = probe_size_and_range(url, pool_size=pool_size)
+    size, range_ok = probe_size_and_range(url, pool_size=pool_size, chunk_bytes=chunk_bytes)
 
     if size <= 0:
         print("Could not determine remote size. Falling back to single-threaded.")
-        return single_thread_download(url, out, chunk_bytes=chunk_bytes, pool_size=16)
+        return single_thread_download(
+            url,
+            out,
+            chunk_bytes=chunk_bytes,
+            pool_size=16,
+            accept_encoding=accept_encoding,
+            expected_sha256=expected_sha256,
+        )
 
     if not range_ok or parts <= 1:
-        return single_thread_download(url, out, chunk_bytes=chunk_bytes, pool_size=16)
+        return single_thread_download(
+            url,
+            out,
+            chunk_bytes=chunk_bytes,
+            pool_size=16,
+            accept_encoding=accept_encoding,
+            expected_sha256=expected_sha256,
+        )
 
-    # Create resume dir + output file pre-sized (important for random writes)
-    state_dir = out + ".parts"
-    os.makedirs(state_dir, exist_ok=True)
+    # Pre-size output file with allocated extents (important for random writes).
+    # Existing bytes are kept, so a resumed download only fills the holes.
+    try:
+        fd = os.open(out, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > size:
+                os.ftruncate(fd, size)
+            _preallocate(fd, size)
+        finally:
+            os.close(fd)
+    except OSError as exc:
+        if exc.errno in (errno.ENOSPC, errno.EFBIG):
+            # A single-threaded download would run out of room just the same
+            print(f"Not enough space for {out} ({size} bytes): {exc.strerror}.")
+            return False
+        # If we can't create/resize, fallback to single-thread
+        print("Could not size output file. Falling back to single-threaded.")
+        return single_thread_download(
+            url,
+            out,
+            chunk_bytes=chunk_bytes,
+            pool_size=16,
+            accept_encoding=accept_encoding,
+            expected_sha256=expected_sha256,
+        )
 
-    # Pre-size output file (sparse-friendly on most filesystems)
-    # If file exists with correct size, keep it; otherwise create/resize.
-    if not os.path.exists(out):
-        with open(out, "wb") as f:
-            f.truncate(size)
-    else:
+    # One fd shared by all workers: pwrite/pwritev carry their own offsets
+    shared_fd = None
+    if direct_io:
+        # O_DIRECT needs block-aligned offsets; the filesystem must accept it too
         try:
-            if os.path.getsize(out) != size:
-                with open(out, "r+b") as f:
-                    f.truncate(size)
-        except Exception:
-            # If we can't stat/resize, fallback to single-thread
-            print("Could not size output file. Falling back to single-threaded.")
-            return single_thread_download(url, out, chunk_bytes=chunk_bytes, pool_size=16)
-
-    part_size = math.ceil(size / parts)
-    tasks = []
-    for i in range(parts):
-        s = i * part_size
-        e = min(s + part_size - 1, size - 1)
-        state_path = os.path.join(state_dir, f"part-{i:04d}.state")
-        tasks.append((s, e, state_path))
-
-    # Initialize progress from state files
-    progress = [0]
-    lock = Lock()
-    for (s, e, sp) in tasks:
-        expected = e - s + 1
-        done = min(_read_state(sp), expected)
-        progress[0] += done
-
-    print(f"Starting FAST parallel download: size={size} bytes, parts={parts}, chunk={chunk_mb} MiB")
-    start_time = time.time()
+            shared_fd = os.open(out, os.O_WRONLY | os.O_DIRECT)
+        except (AttributeError, OSError) as exc:
+            print(f"O_DIRECT not available for {out} ({exc}). Using buffered writes.")
+            direct_io = False
+    if shared_fd is None:
+        shared_fd = os.open(out, os.O_WRONLY)
+
+    # Parts start on block boundaries so every write covers whole filesystem blocks,
+    # as O_DIRECT requires; only the last part's tail is unaligned. 1 MiB is used
+    # only if rounding up to it keeps all requested parts, else 4 KiB.
+    for align in (PART_ALIGN_BYTES, DIRECT_IO_ALIGN):
+        part_size = (math.ceil(size / parts) + align - 1) & ~(align - 1)
+        if math.ceil(size / part_size) >= parts:
+            break
+    tasks = [
+        (i, s, min(s + part_size - 1, size - 1))
+        for i, s in enumerate(range(0, min(parts * part_size, size), part_size))
+    ]
+
+    state_path = out + ".state"
+    state = _open_state(state_path, len(tasks))
+    try:
+        # Initialize progress from saved state. One slot per part, each written only
+        # by its own worker; the display sums them without locking (stale is fine).
+        progress = [min(done, e - s + 1) for done, (_, s, e) in zip(_read_all_state(state, len(tasks)), tasks)]
+
+        multiplex = probe_http2(url)
+        multipart = (
+            not multiplex
+            and size <= MULTIPART_MAX_BYTES
+            and len(tasks) > 1
+            and probe_multipart_ranges(url, pool_size=pool_size)
+        )
 
-    ok = True
-    range_not_supported = False
+        print(
+            f"Starting FAST parallel download: size={size} bytes, parts={len(tasks)}, chunk={chunk_mb} MiB"
+            + (", O_DIRECT" if direct_io else "")
+            + (", HTTP/2 multiplexed" if multiplex else "")
+            + (", multipart/byteranges" if multipart else "")
+        )
+        start_time = time.time()
 
-    with ThreadPoolExecutor(max_workers=min(parts, 64)) as ex:
-        future_map = {}
-        for (s, e, sp) in tasks:
-            fut = ex.submit(
-                download_part_direct,
-                url,
-                out,
-                s,
-                e,
-                sp,
-                progress,
-                lock,
-                retries,
-                1.5,  # backoff
-                chunk_bytes,
-                pool_size,
-            )
-            future_map[fut] = (s, e, sp)
+        ok = True
+        range_not_supported = False
 
-        last_print = 0.0
-        while future_map:
-            done, _ = wait(future_map.keys(), timeout=0.5, return_when=FIRST_COMPLETED)
+        stop_reporter = Event()
+        reporter = Thread(target=_report_progress, args=(progress, size, start_time, stop_reporter), daemon=True)
+        reporter.start()
 
-            now = time.time()
-            if now - last_print >= 0.5:
-                with lock:
-                    done_bytes = progress[0]
-                pct = done_bytes / size * 100.0
-                speed = done_bytes / max(1e-6, now - start_time)
-                sys.stdout.write(
-                    f"\r{done_bytes}/{size} bytes ({pct:.2f}%) at {speed/1024/1024:.2f} MB/s"
-                )
-                sys.stdout.flush()
-                last_print = now
+        verifier = None
+        if expected_sha256:
+            verifier = _OrderedHasher(out, tasks, state, min(chunk_bytes, STAGE_MAX_BYTES), direct_io)
+            verifier_thread = Thread(target=verifier.run, daemon=True)
+            verifier_thread.start()
 
-            for fut in done:
-                s, e, sp = future_map.pop(fut)
+        if multipart:
+            # One request for every range; whatever it leaves unfinished (server cut
+            # the reply short, odd part layout) the per-part workers resume below
+            try:
+                download_parts_multipart(
+                    url,
+                    shared_fd,
+                    out,
+                    tasks,
+                    state,
+                    progress,
+                    chunk_bytes,
+                    pool_size,
+                    direct_io,
+                )
+            except Exception as exc:
+                print(f"\nmultipart/byteranges download stopped ({exc}). Continuing per part.")
+
+        with ThreadPoolExecutor(max_workers=1 if multiplex else min(len(tasks), 64)) as ex:
+            future_map = {}
+            if multiplex:
+                fut = ex.submit(
+                    download_parts_multiplexed,
+                    url,
+                    shared_fd,
+                    out,
+                    tasks,
+                    state,
+                    progress,
+                    retries,
+                    1.5,  # backoff
+                    chunk_bytes,
+                    direct_io,
+                )
+                future_map[fut] = (0, size - 1)
+            else:
+                for (i, s, e) in tasks:
+                    fut = ex.submit(
+                        download_part_direct,
+                        url,
+                        shared_fd,
+                        out,
+                        s,
+                        e,
+                        state,
+                        i,
+                        progress,
+                        retries,
+                        1.5,  # backoff
+                        chunk_bytes,
+                        pool_size,
+                        direct_io,
+                    )
+                    future_map[fut] = (s, e)
+
+            for fut in as_completed(future_map):
+                s, e = future_map[fut]
                 try:
                     success, msg = fut.result()
                     if not success:
@@ -332,48 +1368,70 @@ def parallel_download(url: str, out: str, parts: int, retries: int, chunk_mb: in
                     print(f"\nPart raised exception ({s}-{e}): {exc}")
                     ok = False
 
-    # Final line
-    with lock:
-        done_bytes = progress[0]
-    elapsed = max(1e-6, time.time() - start_time)
-    speed = done_bytes / elapsed
-    pct = done_bytes / size * 100.0
-    print(f"\r{done_bytes}/{size} bytes ({pct:.2f}%) at {speed/1024/1024:.2f} MB/s")
+        stop_reporter.set()
+        reporter.join()
+        if verifier is not None:
+            # Stops at the first incomplete part, else finishes the unhashed tail
+            verifier.downloads_done.set()
+            verifier_thread.join()
+
+        # Final line
+        done_bytes = sum(progress)
+        elapsed = max(1e-6, time.time() - start_time)
+        speed = done_bytes / elapsed
+        pct = done_bytes / size * 100.0
+        print(f"\r{done_bytes}/{size} bytes ({pct:.2f}%) at {speed/1024/1024:.2f} MB/s")
+
+        if range_not_supported:
+            print("Server did not honor Range. Falling back to single-threaded.")
+            return single_thread_download(
+                url,
+                out,
+                chunk_bytes=chunk_bytes,
+                pool_size=16,
+                accept_encoding=accept_encoding,
+                expected_sha256=expected_sha256,
+            )
 
-    if range_not_supported:
-        print("Server did not honor Range. Falling back to single-threaded.")
-        return single_thread_download(url, out, chunk_bytes=chunk_bytes, pool_size=16)
+        if not ok:
+            print("One or more parts failed. Re-run to resume.")
+            return False
 
-    if not ok:
-        print("One or more parts failed. Re-run to resume.")
-        return False
+        # Verify all parts complete
+        for done, (i, s, e) in zip(_read_all_state(state, len(tasks)), tasks):
+            expected = e - s + 1
+            if done < expected:
+                print(f"Part incomplete ({s}-{e}): {done}/{expected}. Re-run to resume.")
+                return False
 
-    # Verify all parts complete
-    for (s, e, sp) in tasks:
-        expected = e - s + 1
-        done = _read_state(sp)
-        if done < expected:
-            print(f"Part incomplete ({s}-{e}): {done}/{expected}. Re-run to resume.")
-            return False
+        # Verify final size
+        try:
+            final_size = os.path.getsize(out)
+            if final_size != size:
+                print(f"Final file size mismatch: got {final_size}, expected {size}.")
+                return False
+        except Exception:
+            pass
 
-    # Verify final size
-    try:
-        final_size = os.path.getsize(out)
-        if final_size != size:
-            print(f"Final file size mismatch: got {final_size}, expected {size}.")
-            return False
-    except Exception:
-        pass
+        # Optional cleanup of the state file (comment out if you like keeping it)
+        try:
+            state.close()
+            os.remove(state_path)
+        except Exception:
+            pass
 
-    # Optional cleanup of state files (comment out if you like keeping them)
-    try:
-        for _, _, sp in tasks:
-            os.remove(sp)
-        os.rmdir(state_dir)
-    except Exception:
-        pass
+        # Checked after the state is gone, so a mismatch re-downloads everything on re-run
+        if verifier is not None:
+            if verifier.error is not None or verifier.offset != size:
+                print(f"Could not hash {out} ({verifier.error or 'incomplete read'}).")
+                return False
+            return _sha256_matches(verifier.hasher.hexdigest(), expected_sha256)
 
-    return True
+        return True
+    finally:
+        if not state.closed:
+            state.close()
+        os.close(shared_fd)
 
 
 def main():
@@ -383,9 +1441,36 @@ def main():
     p.add_argument("--parts", type=int, default=32, help="Number of parallel ranges (try 16-64)")
     p.add_argument("--retries", type=int, default=5, help="Retries per part")
     p.add_argument("--chunk-mb", type=int, default=8, help="Chunk size per read in MiB (4-16 often good)")
+    p.add_argument(
+        "--direct-io",
+        action="store_true",
+        help="Write parts with O_DIRECT (bypasses the page cache; Linux, parallel mode only)",
+    )
+    p.add_argument(
+        "--accept-encoding",
+        default=None,
+        help="Accept-Encoding for single-threaded downloads (default: identity). 'auto' accepts every "
+        f"decodable encoding ('{DECODABLE_ENCODINGS}'); compressed bodies are saved decoded, so a "
+        "server-labelled .gz would be unpacked. Ignored with --expected-sha256; Range downloads "
+        "always use identity.",
+    )
+    p.add_argument(
+        "--expected-sha256",
+        default=None,
+        help="Hex SHA-256 of the file; computed during the download and checked at the end",
+    )
     args = p.parse_args()
 
-    success = parallel_download(args.url, args.out, parts=args.parts, retries=args.retries, chunk_mb=args.chunk_mb)
+    success = parallel_download(
+        args.url,
+        args.out,
+        parts=args.parts,
+        retries=args.retries,
+        chunk_mb=args.chunk_mb,
+        direct_io=args.direct_io,
+        accept_encoding=args.accept_encoding,
+        expected_sha256=args.expected_sha256,
+    )
     if not success:
         print("Download incomplete or failed")
         sys.exit(2)